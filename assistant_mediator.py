@@ -6,25 +6,38 @@ Orchestrates a dialogue between:
   - Customer assistant (skeptical late-40s customer with some technical background)
 
 Requirements:
-  pip install --upgrade openai
+  pip install --upgrade openai numpy tiktoken "httpx[http2]"
 
 Usage:
   1) Set environment var:  export OPENAI_API_KEY="sk-..."
   2) python assistant_mediator.py
+     (set DIALOGUES=N to run N independent dialogues concurrently,
+      SEMANTIC_CACHE_DIR=path to reuse near-identical replies across runs)
 """
 
 import os
 import re
-import json
+import asyncio
 from datetime import datetime
-from typing import Dict, Any, List
-from openai import OpenAI
+from typing import Callable, Dict, List
+import httpx
+from openai import AsyncOpenAI
+
+from mediator_core import (
+    ACCEPT_RE,
+    SemanticCache,
+    call_chat_async,
+    call_chat_candidates_async,
+    classify_verdict,
+    compact_history_async,
+    dumps_json,
+)
 
 # -----------------------------
 # Configurable parameters
 # -----------------------------
 MODEL_CONSULTANT = os.getenv("MODEL_CONSULTANT", "gpt-4o")
-MODEL_CUSTOMER   = os.getenv("MODEL_CUSTOMER", "gpt-4o")
+MODEL_CUSTOMER   = os.getenv("MODEL_CUSTOMER", "gpt-4o-mini")
 
 TEMP_CONSULTANT  = float(os.getenv("TEMP_CONSULTANT", "0.70"))
 TEMP_CUSTOMER    = float(os.getenv("TEMP_CUSTOMER", "0.45"))
@@ -32,115 +45,138 @@ TEMP_CUSTOMER    = float(os.getenv("TEMP_CUSTOMER", "0.45"))
 TOP_P_CONSULTANT = float(os.getenv("TOP_P_CONSULTANT", "1.0"))
 TOP_P_CUSTOMER   = float(os.getenv("TOP_P_CUSTOMER", "1.0"))
 
+MAX_TOKENS_CONSULTANT = int(os.getenv("MAX_TOKENS_CONSULTANT", "700"))   # reply length caps
+MAX_TOKENS_CUSTOMER   = int(os.getenv("MAX_TOKENS_CUSTOMER", "300"))
+
 MAX_TURNS        = int(os.getenv("MAX_TURNS", "12"))   # max back-and-forth pairs
 LOG_DIR          = os.getenv("LOG_DIR", ".")
+os.makedirs(LOG_DIR, exist_ok=True)
+DIALOGUES        = int(os.getenv("DIALOGUES", "1"))    # independent dialogues run concurrently
+SEMANTIC_CACHE_DIR = os.getenv("SEMANTIC_CACHE_DIR", "")  # set to reuse near-identical replies across runs
+
+# History compaction: once a history (minus its system prompt) exceeds the
+# threshold, older messages are summarised down to about half of it, always
+# keeping at least the newest SUMMARY_KEEP_MESSAGES. At the default reply caps
+# those are ~2k tokens, so the threshold leaves room for a few turns.
+SUMMARY_MODEL            = os.getenv("SUMMARY_MODEL", "gpt-4o-mini")
+SUMMARY_THRESHOLD_TOKENS = int(os.getenv("SUMMARY_THRESHOLD_TOKENS", "6000"))
+SUMMARY_KEEP_MESSAGES    = int(os.getenv("SUMMARY_KEEP_MESSAGES", "4"))
 
-# Acceptance / rejection phrases
-ACCEPT_PATTERNS = [
-    r"\bI am convinced\b",
-    r"\bI accept this idea\b",
-    r"\bThis is (feasible|profitable)\b",
-    r"\bI agree to proceed\b",
-]
-REJECT_PATTERNS = [
-    r"\bI reject this idea\b",
-    r"\bThis won't work\b",
-    r"\bNot acceptable\b",
-    r"\bI am not convinced\b",
-]
-
-def is_match(text: str, patterns: List[str]) -> bool:
-    for pat in patterns:
-        if re.search(pat, text, flags=re.IGNORECASE):
-            return True
-    return False
+# Opening ideas: request CANDIDATES completions in one call, let RANK_MODEL pick
+# the best, and keep the rest to try before paying for a fresh idea.
+CANDIDATES = int(os.getenv("CANDIDATES", "3"))
+RANK_MODEL = os.getenv("RANK_MODEL", "gpt-4o-mini")
 
 # -----------------------------
 # System instructions
 # -----------------------------
-CONSULTANT_SYSTEM = """You are an AI Business Consultant and Subject Matter Expert (SME) in both business strategy and the technical field relevant to the solutions you propose.
-
-Goals:
-- Propose unique, profitable business ideas powered almost entirely by AI.
-- Ensure:
-  - 85%+ of implementation is AI-driven (low-code, automated setup, minimal manual work).
-  - 100% of operations are AI-autonomous (no recurring human effort to run the service).
-  - Low-cost implementation – leverage existing APIs, SaaS tools, and open-source frameworks; avoid heavy infra or large teams.
-
-Deliver every idea in this structured format:
-  1. Problem Statement
-  2. AI Solution
-  3. AI Utilization %
-  4. Deployment & Cost Feasibility
-  5. Business Value
-  6. Revenue Model
-  7. Uniqueness Factor
-  8. Scalability & Sustainability
-
-Behavior:
-- Propose only one idea at a time.
-- Respond concisely and defend your idea when challenged.
-- Do not abandon the idea too quickly — refine it if needed until the customer is convinced or firmly rejects it.
-- Be professional, practical, and ROI-focused.
-- Continue the dialogue until the customer explicitly accepts or rejects the idea.
+CONSULTANT_SYSTEM = """You are an AI business consultant and SME in business strategy and the relevant technical field.
+
+Propose unique, profitable business ideas run almost entirely by AI:
+- 85%+ of implementation AI-driven (low-code, automated setup).
+- 100% of operations AI-autonomous (no recurring human effort).
+- Low cost: existing APIs, SaaS and open-source; no heavy infra or large teams.
+
+Structure every idea as: 1. Problem Statement, 2. AI Solution, 3. AI Utilization %, 4. Deployment & Cost Feasibility, 5. Business Value, 6. Revenue Model, 7. Uniqueness Factor, 8. Scalability & Sustainability.
+
+One idea at a time. Be concise, practical and ROI-focused. Defend and refine the idea when challenged; don't drop it until the customer explicitly accepts or rejects it.
 """
 
-CUSTOMER_SYSTEM = """You are the Customer, a late-40s analytical individual seeking an online business opportunity. You have some technical background (comfortable with tools, APIs, and basic automation concepts) but are not a deep SME. You love creativity and want to build something that delivers real value to others.
-
-Personality & Behavior:
-- Skeptical: Demand evidence, numbers, and validation for every claim.
-- Cost-sensitive: Only accept ideas that require minimal startup investment and low running costs.
-- Analytical: Probe assumptions, ROI, risks, and feasibility.
-- Value-driven: Reject purely money-chasing ideas unless they deliver real customer benefit.
-- Technically aware: Understand basic AI/automation but request clear, simplified explanations.
-- Challenging: Rarely accept vague answers — push for clarity and proof.
-
-Goals:
-- Focus on one idea at a time.
-- Challenge the consultant until the business idea is proven feasible, profitable, low-cost, and valuable.
-- Expose flaws in weak ideas.
-- Demand uniqueness — reject generic or oversaturated models.
-- Once you are fully satisfied, clearly state acceptance with a phrase like:
-  - "I am convinced." OR "I accept this idea." OR "This is feasible and profitable."
-- If you reject the idea, state it clearly (e.g., "I reject this idea because..."). Only then request another idea.
+CUSTOMER_SYSTEM = """You are the Customer: late 40s, analytical, seeking an online business. Technically literate (tools, APIs, basic automation), not an SME. You value creativity and real benefit to others.
+
+- Skeptical: demand evidence, numbers and validation.
+- Cost-sensitive: accept only minimal startup investment and low running costs.
+- Probe assumptions, ROI, risks and feasibility; push back on vague answers.
+- Reject money-chasing ideas without real customer benefit, and generic or oversaturated ones.
+- Want simple explanations of the AI/automation involved.
+
+Focus on one idea. Challenge it until it is proven feasible, profitable, low-cost, valuable and unique.
+When fully satisfied, say "I am convinced." or "I accept this idea."
+When rejecting, say "I reject this idea because..." and only then ask for another idea.
+"""
+
+RANK_SYSTEM = """You compare AI-first online business ideas.
+Rank them by ROI and low startup/running cost, then reply with ONLY the number of the best idea.
 """
 
 # -----------------------------
 # OpenAI client
 # -----------------------------
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-def call_chat(model: str, system: str, user: str, temperature: float, top_p: float) -> str:
-    """Call Chat Completions and return text content."""
-    resp = client.chat.completions.create(
-        model=model,
-        temperature=temperature,
-        top_p=top_p,
+# One pooled HTTP/2 client: concurrent dialogues multiplex over kept-alive connections.
+aclient = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=httpx.AsyncClient(http2=True, limits=httpx.Limits(max_keepalive_connections=10)),
+)
+cache = SemanticCache(SEMANTIC_CACHE_DIR) if SEMANTIC_CACHE_DIR else None
+
+async def pick_best_idea(candidates: List[str]) -> int:
+    """Return the index of the candidate RANK_MODEL rates best (0 if unclear)."""
+    if len(candidates) == 1:
+        return 0
+    answer = await call_chat_async(
+        aclient,
+        model=RANK_MODEL,
         messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
+            {"role": "system", "content": RANK_SYSTEM},
+            {"role": "user", "content": "\n\n".join(f"IDEA {i + 1}:\n{c}" for i, c in enumerate(candidates))},
         ],
+        temperature=0,
+        top_p=1.0,
+        max_tokens=8,   # only a number is expected
+        # The answer indexes this run's candidates: only an exact repeat of
+        # the same candidate list may reuse it.
+        cache=cache,
+        semantic=False,
     )
-    return resp.choices[0].message.content.strip()
+    m = re.search(r"\d+", answer)
+    index = int(m.group()) - 1 if m else 0
+    return index if 0 <= index < len(candidates) else 0
 
-def main() -> None:
-    transcript: List[Dict[str, Any]] = []
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+async def compact_history(messages: List[Dict[str, str]], model: str) -> None:
+    """Summarise old turns of ``messages`` in place once it exceeds the threshold.
+
+    Not cached: every summary request shares one cache partition, so a hit
+    would put another dialogue's summary into this one.
+    """
+    await compact_history_async(
+        aclient,
+        messages,
+        model,
+        threshold=SUMMARY_THRESHOLD_TOKENS,
+        keep=SUMMARY_KEEP_MESSAGES,
+        summary_model=SUMMARY_MODEL,
+    )
+
+async def converse(label: str, record: Callable[[str, str], None]) -> None:
+    """Run one consultant/customer dialogue, passing each reply to ``record(role, content)``."""
+    consultant_msgs: List[Dict[str, str]] = [{"role": "system", "content": CONSULTANT_SYSTEM}]
+    customer_msgs: List[Dict[str, str]] = [{"role": "system", "content": CUSTOMER_SYSTEM}]
 
     # 1) Consultant starts with a single best idea
-    consultant_prompt = (
+    consultant_msgs.append({"role": "user", "content": (
         "Propose your single best AI-first online business idea that meets all your constraints. "
         "Follow your 8-section structure. Do not list multiple ideas."
-    )
-    consultant_reply = call_chat(
+    )})
+    candidates = await call_chat_candidates_async(
+        aclient,
         model=MODEL_CONSULTANT,
-        system=CONSULTANT_SYSTEM,
-        user=consultant_prompt,
+        messages=consultant_msgs,
         temperature=TEMP_CONSULTANT,
         top_p=TOP_P_CONSULTANT,
+        n=CANDIDATES,
+        max_tokens=MAX_TOKENS_CONSULTANT,
+    )
+    consultant_reply = candidates.pop(await pick_best_idea(candidates))
+    spare_ideas = candidates
+    consultant_msgs.append({"role": "assistant", "content": consultant_reply})
+    print(f"\n{label}👔 Consultant:\n", consultant_reply, "\n")
+    record("consultant", consultant_reply)
+
+    customer_user = (
+        "Act as the skeptical customer. Challenge the following proposal until you are convinced or reject it. "
+        "Focus on ROI, feasibility, low cost, uniqueness, and proof. "
+        "Remember to say explicitly if you accept or reject.\n\nPROPOSAL:\n" + consultant_reply
     )
-    print("\n👔 Consultant:\n", consultant_reply, "\n")
-    transcript.append({"role": "consultant", "content": consultant_reply})
 
     # 2) Dialogue loop
     turn = 0
@@ -148,63 +184,108 @@ def main() -> None:
         turn += 1
 
         # Customer challenges
-        customer_user = (
-            "Act as the skeptical customer. Challenge the following proposal until you are convinced or reject it. "
-            "Focus on ROI, feasibility, low cost, uniqueness, and proof. "
-            "Remember to say explicitly if you accept or reject.\n\nPROPOSAL:\n" + consultant_reply
-        )
-        customer_reply = call_chat(
-            model=MODEL_CUSTOMER,
-            system=CUSTOMER_SYSTEM,
-            user=customer_user,
-            temperature=TEMP_CUSTOMER,
-            top_p=TOP_P_CUSTOMER,
+        customer_msgs.append({"role": "user", "content": customer_user})
+
+        async def customer_turn() -> str:
+            await compact_history(customer_msgs, MODEL_CUSTOMER)
+            return await call_chat_async(
+                aclient,
+                model=MODEL_CUSTOMER,
+                messages=customer_msgs,
+                temperature=TEMP_CUSTOMER,
+                top_p=TOP_P_CUSTOMER,
+                max_tokens=MAX_TOKENS_CUSTOMER,
+                stop_re=ACCEPT_RE,
+                cache=cache,
+            )
+
+        # Keep both histories bounded. The consultant's history isn't needed
+        # until the customer has replied, so compact it while that reply is
+        # in flight instead of before it.
+        customer_reply, _ = await asyncio.gather(
+            customer_turn(),
+            compact_history(consultant_msgs, MODEL_CONSULTANT),
         )
-        print("🧑 Customer:\n", customer_reply, "\n")
-        transcript.append({"role": "customer", "content": customer_reply})
+        customer_msgs.append({"role": "assistant", "content": customer_reply})
+        print(f"{label}🧑 Customer:\n", customer_reply, "\n")
+        record("customer", customer_reply)
 
         # Check acceptance/rejection
-        if is_match(customer_reply, ACCEPT_PATTERNS):
-            print("✅ Customer accepted the idea.")
+        verdict = classify_verdict(customer_reply)
+        if verdict == "accept":
+            print(f"{label}✅ Customer accepted the idea.")
             break
-        if is_match(customer_reply, REJECT_PATTERNS):
+        if verdict == "reject":
             # Ask consultant to propose a *new* single idea addressing the stated reasons.
             consultant_user = (
-                "The customer rejected your idea with the response below. "
-                "Propose a different, single idea that addresses the customer's reasons, "
-                "still following your 8-section structure and all your constraints. "
-                "Do not list multiple ideas.\n\nCUSTOMER RESPONSE:\n" + customer_reply
+                "The customer rejected your idea. Propose a different, single idea that addresses "
+                "their reasons, following your 8-section structure.\n\nCUSTOMER RESPONSE:\n" + customer_reply
             )
+            proposal_header = "NEW PROPOSAL (a different idea):\n"
+            if spare_ideas:
+                # Already paid for in the opening request; try it before generating a new one.
+                consultant_reply = spare_ideas.pop(0)
+                consultant_msgs.append({"role": "user", "content": consultant_user})
+                consultant_msgs.append({"role": "assistant", "content": consultant_reply})
+                print(f"{label}👔 Consultant (next candidate):\n", consultant_reply, "\n")
+                record("consultant", consultant_reply)
+                customer_user = proposal_header + consultant_reply
+                continue
         else:
             # Customer is challenging; ask consultant to refine the same idea
             consultant_user = (
-                "The customer is challenging your idea. Refine the SAME idea to address every objection. "
-                "Keep it a single idea. Be concise, data-driven, and defend feasibility/ROI/low-cost clearly.\n\n"
+                "Refine the SAME idea to address every objection. Be concise and data-driven.\n\n"
                 "CUSTOMER CHALLENGES:\n" + customer_reply
             )
+            proposal_header = "REFINED PROPOSAL:\n"
 
-        consultant_reply = call_chat(
+        consultant_msgs.append({"role": "user", "content": consultant_user})
+        consultant_reply = await call_chat_async(
+            aclient,
             model=MODEL_CONSULTANT,
-            system=CONSULTANT_SYSTEM,
-            user=consultant_user,
+            messages=consultant_msgs,
             temperature=TEMP_CONSULTANT,
             top_p=TOP_P_CONSULTANT,
+            max_tokens=MAX_TOKENS_CONSULTANT,
+            cache=cache,
         )
-        print("👔 Consultant (refinement):\n", consultant_reply, "\n")
-        transcript.append({"role": "consultant", "content": consultant_reply})
-
-    # Save transcript
-    os.makedirs(LOG_DIR, exist_ok=True)
-    base = os.path.join(LOG_DIR, f"two_assistants_dialog_{timestamp}")
-    with open(base + ".json", "w", encoding="utf-8") as f:
-        json.dump(transcript, f, ensure_ascii=False, indent=2)
-    with open(base + ".md", "w", encoding="utf-8") as f:
-        f.write("# Two-Assistant Dialogue Transcript\n\n")
-        for turn in transcript:
-            speaker = "Consultant" if turn["role"] == "consultant" else "Customer"
-            f.write(f"## {speaker}\n\n{turn['content']}\n\n---\n\n")
-
-    print(f"Transcript saved to: {base}.json and {base}.md")
+        consultant_msgs.append({"role": "assistant", "content": consultant_reply})
+        print(f"{label}👔 Consultant (refinement):\n", consultant_reply, "\n")
+        record("consultant", consultant_reply)
+        customer_user = proposal_header + consultant_reply
+
+async def run_dialogue(index: int, timestamp: str) -> None:
+    """Run one dialogue, appending each reply to its transcript files as it arrives.
+
+    Turns go to a JSONL file (one object per line) and a Markdown file that are
+    flushed after every reply, so a crash mid-run keeps everything said so far.
+    """
+    # Only label output when several dialogues interleave on stdout.
+    label = f"[dialogue {index + 1}] " if DIALOGUES > 1 else ""
+    suffix = f"_{index + 1}" if DIALOGUES > 1 else ""
+    base = os.path.join(LOG_DIR, f"two_assistants_dialog_{timestamp}{suffix}")
+
+    with open(base + ".jsonl", "w", encoding="utf-8") as f_jsonl, open(base + ".md", "w", encoding="utf-8") as f_md:
+        f_md.write("# Two-Assistant Dialogue Transcript\n\n")
+
+        def record(role: str, content: str) -> None:
+            f_jsonl.write(dumps_json({"role": role, "content": content}) + "\n")
+            speaker = "Consultant" if role == "consultant" else "Customer"
+            f_md.write(f"## {speaker}\n\n{content}\n\n---\n\n")
+            f_jsonl.flush()
+            f_md.flush()
+
+        await converse(label, record)
+
+    print(f"{label}Transcript saved to: {base}.jsonl and {base}.md")
+
+async def main_async() -> None:
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # Dialogues are independent, so their network round-trips overlap.
+    await asyncio.gather(*(run_dialogue(i, timestamp) for i in range(DIALOGUES)))
+
+def main() -> None:
+    asyncio.run(main_async())
 
 if __name__ == "__main__":
     main()
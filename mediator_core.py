@@ -0,0 +1,423 @@
+"""
+Mediator Core
+-------------
+Shared by both entrypoints (assistant_mediator.py and streamlit_app.py):
+  - verdict detection on customer replies (Aho-Corasick via the optional
+    pyahocorasick package, regex otherwise, or a JSON-mode verdict field)
+  - transcript JSON serialization (orjson when installed)
+  - token counting and summary-based history compaction
+  - Chat Completions helpers (blocking, streaming and asyncio) that run
+    through an optional SemanticCache
+
+Keeping these in one imported module means they are compiled once (and
+served from __pycache__ afterwards) instead of drifting between copies.
+"""
+
+import re
+import json
+import functools
+from typing import Dict, Iterator, List, Optional, Pattern, Tuple
+
+import tiktoken
+
+import semantic_cache
+from semantic_cache import SemanticCache
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+Messages = List[Dict[str, str]]
+
+# -----------------------------
+# Verdict detection
+# -----------------------------
+# Verdict phrases are plain literals (matched case-insensitively on word
+# boundaries); the regex fallback is derived from the same table.
+ACCEPT_PHRASES = [
+    "I am convinced",
+    "I accept this idea",
+    "This is feasible",
+    "This is profitable",
+    "I agree to proceed",
+]
+REJECT_PHRASES = [
+    "I reject this idea",
+    "This won't work",
+    "Not acceptable",
+    "I am not convinced",
+]
+ACCEPT_PATTERNS = [rf"\b{re.escape(p)}\b" for p in ACCEPT_PHRASES]
+REJECT_PATTERNS = [rf"\b{re.escape(p)}\b" for p in REJECT_PHRASES]
+VERDICT_RE = re.compile(
+    f"(?P<accept>{'|'.join(ACCEPT_PATTERNS)})|(?P<reject>{'|'.join(REJECT_PATTERNS)})",
+    re.IGNORECASE,
+)
+# Early-stop pattern for streamed customer replies (pass as ``stop_re``). Only
+# acceptance ends a reply early: the dialogue stops there anyway, while a
+# rejection's reasons come after the phrase and are still needed.
+ACCEPT_RE = re.compile("|".join(ACCEPT_PATTERNS), re.IGNORECASE)
+# How far behind each new delta a stop_re search starts; longer than any phrase.
+STOP_LOOKBACK = 256
+
+def _build_automaton():
+    automaton = ahocorasick.Automaton()
+    for verdict, phrases in (("accept", ACCEPT_PHRASES), ("reject", REJECT_PHRASES)):
+        for phrase in phrases:
+            key = phrase.lower()
+            automaton.add_word(key, (verdict, len(key)))
+    automaton.make_automaton()
+    return automaton
+
+VERDICT_AUTOMATON = _build_automaton() if ahocorasick is not None else None
+
+def _is_word_char(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+def classify_verdict(text: str) -> Optional[str]:
+    """Return "accept", "reject" or None after a single scan of the reply.
+
+    An acceptance phrase anywhere in the text wins over a rejection phrase.
+    Uses an Aho-Corasick automaton (one O(len(text)) pass regardless of the
+    number of phrases) when pyahocorasick is installed, else VERDICT_RE.
+    """
+    verdict = None
+    if VERDICT_AUTOMATON is None:
+        for m in VERDICT_RE.finditer(text):
+            if m.lastgroup == "accept":
+                return "accept"
+            verdict = "reject"
+        return verdict
+
+    lowered = text.lower()
+    for end, (kind, length) in VERDICT_AUTOMATON.iter(lowered):
+        start = end - length + 1
+        # Same word-boundary rule as the regex's \b...\b.
+        if (start > 0 and _is_word_char(lowered[start - 1])) or (
+            end + 1 < len(lowered) and _is_word_char(lowered[end + 1])
+        ):
+            continue
+        if kind == "accept":
+            return "accept"
+        verdict = "reject"
+    return verdict
+
+VERDICT_JSON_FORMAT = {"type": "json_object"}
+
+def parse_verdict_reply(reply: str) -> Tuple[Optional[str], str]:
+    """Split a JSON-mode customer reply into (verdict, rebuttal text).
+
+    Expects ``{"verdict": "accept" | "reject" | "continue", "rebuttal": "..."}``;
+    the verdict is then a field lookup rather than a scan of the prose.
+    "continue" maps to None, like classify_verdict. A reply that isn't such
+    an object falls back to classify_verdict over the raw text.
+    """
+    try:
+        data = json.loads(reply)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return classify_verdict(reply), reply
+    verdict = data.get("verdict")
+    text = str(data.get("rebuttal") or "").strip() or reply
+    return (verdict if verdict in ("accept", "reject") else None), text
+
+# -----------------------------
+# Transcript serialization
+# -----------------------------
+def dumps_json(obj, indent: bool = False) -> str:
+    """Serialize ``obj`` to a JSON string (non-ASCII kept as-is).
+
+    orjson's Rust encoder is several times faster than the stdlib, especially
+    for pretty-printed output; the stdlib is used when it isn't installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None)
+
+def dumps_json_bytes(obj, indent: bool = False) -> bytes:
+    """Like dumps_json but UTF-8 bytes, which is what orjson produces natively."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+# -----------------------------
+# Semantic cache plumbing
+# -----------------------------
+# ``semantic=False`` restricts a call to the exact-match layer. Use it for
+# single-shot utility requests (a static system prompt plus one generated user
+# message, e.g. summaries or rankings): they all share one partition, so a
+# near-identical message from another dialogue would be answered with that
+# dialogue's reply.
+CacheKey = Tuple[Optional[str], Optional[str], Optional[List[float]]]
+
+def _cache_probe(cache: SemanticCache, model: str, messages: Messages, temperature: float, top_p: float):
+    exact = semantic_cache.exact_key(model, messages, temperature, top_p) if temperature == 0 else None
+    return exact, (cache.get_exact(exact) if exact else None)
+
+def _cache_lookup(client, cache, model, messages, temperature, top_p, semantic=True) -> Tuple[Optional[str], Optional[CacheKey]]:
+    """Return (cached reply or None, key to pass to _cache_store on a miss)."""
+    exact, hit = _cache_probe(cache, model, messages, temperature, top_p)
+    if hit is not None:
+        return hit, None
+    if not semantic:
+        return None, (exact, None, None)
+    partition = semantic_cache.partition_key(model, messages)
+    emb = client.embeddings.create(
+        model=semantic_cache.EMBEDDING_MODEL,
+        input=semantic_cache.embedding_input(messages),
+    )
+    embedding = emb.data[0].embedding
+    return cache.lookup(partition, embedding), (exact, partition, embedding)
+
+async def _cache_lookup_async(aclient, cache, model, messages, temperature, top_p, semantic=True) -> Tuple[Optional[str], Optional[CacheKey]]:
+    exact, hit = _cache_probe(cache, model, messages, temperature, top_p)
+    if hit is not None:
+        return hit, None
+    if not semantic:
+        return None, (exact, None, None)
+    partition = semantic_cache.partition_key(model, messages)
+    emb = await aclient.embeddings.create(
+        model=semantic_cache.EMBEDDING_MODEL,
+        input=semantic_cache.embedding_input(messages),
+    )
+    embedding = emb.data[0].embedding
+    return cache.lookup(partition, embedding), (exact, partition, embedding)
+
+def _cache_store(cache: SemanticCache, key: CacheKey, reply: str) -> None:
+    exact, partition, embedding = key
+    if partition is not None:
+        cache.add(partition, embedding, reply)
+    if exact:
+        cache.put_exact(exact, reply)
+
+# -----------------------------
+# Chat Completions helpers
+# -----------------------------
+# `messages` is always the assistant's running history. Callers append to it
+# rather than rebuilding it, so the system prompt and earlier turns form a
+# byte-stable prefix the provider can cache.
+
+def call_chat(client, model: str, messages: Messages, temperature: float, top_p: float,
+              cache: Optional[SemanticCache] = None, max_tokens: Optional[int] = None,
+              response_format: Optional[Dict[str, str]] = None, semantic: bool = True) -> str:
+    """Blocking call; returns the reply text.
+
+    ``response_format`` is passed through (e.g. VERDICT_JSON_FORMAT) when given.
+    """
+    if cache is not None:
+        hit, key = _cache_lookup(client, cache, model, messages, temperature, top_p, semantic)
+        if hit is not None:
+            return hit
+
+    r = client.chat.completions.create(
+        model=model,
+        temperature=temperature,
+        top_p=top_p,
+        messages=messages,
+        max_tokens=max_tokens,
+        **({"response_format": response_format} if response_format else {}),
+    )
+    reply = r.choices[0].message.content.strip()
+
+    if cache is not None:
+        _cache_store(cache, key, reply)
+    return reply
+
+def stream_chat(client, model: str, messages: Messages, temperature: float, top_p: float,
+                cache: Optional[SemanticCache] = None, max_tokens: Optional[int] = None,
+                stop_re: Optional[Pattern[str]] = None, semantic: bool = True) -> Iterator[str]:
+    """Streaming call; yields text deltas as they arrive (e.g. for st.write_stream).
+
+    Once ``stop_re`` matches the text so far, the response is closed so the
+    server stops generating (and billing) the rest of the reply. Each check
+    only scans the new delta plus STOP_LOOKBACK characters before it.
+    """
+    if cache is not None:
+        hit, key = _cache_lookup(client, cache, model, messages, temperature, top_p, semantic)
+        if hit is not None:
+            yield hit
+            return
+
+    stream = client.chat.completions.create(
+        model=model,
+        temperature=temperature,
+        top_p=top_p,
+        messages=messages,
+        max_tokens=max_tokens,
+        stream=True,
+    )
+    text = ""
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        text += delta
+        yield delta
+        if stop_re is not None and stop_re.search(text, max(0, len(text) - len(delta) - STOP_LOOKBACK)):
+            stream.close()
+            break
+
+    if cache is not None:
+        _cache_store(cache, key, text.strip())
+
+async def call_chat_async(aclient, model: str, messages: Messages, temperature: float, top_p: float,
+                          cache: Optional[SemanticCache] = None, max_tokens: Optional[int] = None,
+                          stop_re: Optional[Pattern[str]] = None, semantic: bool = True) -> str:
+    """asyncio call on an AsyncOpenAI client; returns the reply text.
+
+    With ``stop_re`` the reply is streamed internally and cut off as in stream_chat.
+    """
+    if cache is not None:
+        hit, key = await _cache_lookup_async(aclient, cache, model, messages, temperature, top_p, semantic)
+        if hit is not None:
+            return hit
+
+    if stop_re is None:
+        resp = await aclient.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            top_p=top_p,
+            messages=messages,
+            max_tokens=max_tokens,
+        )
+        reply = resp.choices[0].message.content.strip()
+    else:
+        stream = await aclient.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            top_p=top_p,
+            messages=messages,
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        reply = ""
+        async for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content or ""
+            reply += delta
+            if stop_re.search(reply, max(0, len(reply) - len(delta) - STOP_LOOKBACK)):
+                await stream.close()
+                break
+        reply = reply.strip()
+
+    if cache is not None:
+        _cache_store(cache, key, reply)
+    return reply
+
+async def call_chat_candidates_async(aclient, model: str, messages: Messages, temperature: float, top_p: float,
+                                     n: int, max_tokens: Optional[int] = None) -> List[str]:
+    """Request ``n`` alternative completions in a single round-trip."""
+    resp = await aclient.chat.completions.create(
+        model=model,
+        temperature=temperature,
+        top_p=top_p,
+        messages=messages,
+        n=n,
+        max_tokens=max_tokens,
+    )
+    return [c.message.content.strip() for c in resp.choices]
+
+# -----------------------------
+# History compaction
+# -----------------------------
+# Once a history (minus its system prompt) exceeds the threshold, its older
+# messages are replaced by a cheap-model summary, leaving the history at about
+# half the threshold so it can grow for several turns before the next summary
+# (and its prefix stays stable meanwhile). Only the messages sent to the model
+# are compacted; transcripts stay verbatim.
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_PREFIX = "Summary of the earlier dialogue:\n"
+
+SUMMARY_SYSTEM = """Summarize the following dialogue in one paragraph.
+Preserve the proposal's key figures, every open objection, and all stated constraints.
+"""
+
+@functools.lru_cache(maxsize=4)
+def _enc(model: str) -> "tiktoken.Encoding":
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+@functools.lru_cache(maxsize=1024)
+def _content_tokens(model: str, content: str) -> int:
+    return len(_enc(model).encode(content))
+
+def count_tokens(model: str, messages: Messages) -> int:
+    # Memoised per message, so each turn only tokenizes what was appended.
+    return sum(_content_tokens(model, m["content"]) for m in messages)
+
+def _split_for_summary(messages: Messages, model: str, threshold: int, keep: int) -> Optional[Tuple[Messages, Messages]]:
+    """Return (old, recent) when ``messages`` needs compacting, else None.
+
+    ``recent`` is the newest ``keep`` messages plus as many older ones as fit
+    within half the threshold in total.
+    """
+    body = messages[1:]
+    if len(body) <= keep or count_tokens(model, body) <= threshold:
+        return None
+    split = len(body) - keep
+    used = count_tokens(model, body[split:])
+    while split > 1:
+        cost = _content_tokens(model, body[split - 1]["content"])
+        if used + cost > threshold // 2:
+            break
+        used += cost
+        split -= 1
+    old = body[:split]
+    # Nothing but an earlier summary to fold in (the newest ``keep`` messages
+    # alone exceed the threshold): re-summarising it would cost a call per
+    # turn and rewrite the prefix without shrinking anything.
+    if all(_is_summary(m) for m in old):
+        return None
+    return old, body[split:]
+
+def _summary_request(old: Messages) -> Messages:
+    return [
+        {"role": "system", "content": SUMMARY_SYSTEM},
+        {"role": "user", "content": "\n\n".join(f"{m['role'].upper()}: {m['content']}" for m in old)},
+    ]
+
+def _summary_message(summary: str) -> Dict[str, str]:
+    return {"role": "system", "content": SUMMARY_PREFIX + summary}
+
+def _is_summary(message: Dict[str, str]) -> bool:
+    return message["role"] == "system" and message["content"].startswith(SUMMARY_PREFIX)
+
+def compact_history(client, messages: Messages, model: str, threshold: int, keep: int,
+                    summary_model: str = SUMMARY_MODEL) -> None:
+    """Replace the oldest turns of ``messages`` (in place) with a summary.
+
+    Keeps prompt size bounded instead of growing with every turn. The system
+    prompt and at least the newest ``keep`` messages are always sent verbatim;
+    ``threshold`` should leave room for those plus a few more turns.
+    Summaries are never cached: every summary request shares one cache
+    partition, so a hit would carry another dialogue's facts.
+    """
+    split = _split_for_summary(messages, model, threshold, keep)
+    if split is None:
+        return
+    old, recent = split
+    summary = call_chat(client, summary_model, _summary_request(old), temperature=0, top_p=1.0,
+                        max_tokens=SUMMARY_MAX_TOKENS)
+    messages[1:] = [_summary_message(summary), *recent]
+
+async def compact_history_async(aclient, messages: Messages, model: str, threshold: int, keep: int,
+                                summary_model: str = SUMMARY_MODEL) -> None:
+    """asyncio variant of compact_history."""
+    split = _split_for_summary(messages, model, threshold, keep)
+    if split is None:
+        return
+    old, recent = split
+    summary = await call_chat_async(aclient, summary_model, _summary_request(old), temperature=0, top_p=1.0,
+                                    max_tokens=SUMMARY_MAX_TOKENS)
+    messages[1:] = [_summary_message(summary), *recent]
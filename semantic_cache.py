@@ -0,0 +1,117 @@
+"""
+Semantic Response Cache
+-----------------------
+Remembers chat completions next to an embedding of the request, so a repeated
+or near-identical request (cosine similarity >= threshold) is answered locally
+instead of paying for another LLM round-trip.
+
+  - Entries are partitioned by (model, everything before the newest message),
+    and similarity is judged on the newest message alone; otherwise
+    consecutive turns, which share most of their history, would look alike
+    and replay the previous turn's reply. For a running dialogue that means
+    a reply is only reused at the same point of the same dialogue. Single-shot
+    requests (static system prompt plus one generated message) all share a
+    partition, so callers must keep such requests out of the semantic layer.
+  - Temperature-0 requests can also hit an exact-match cache, which needs no
+    embedding call at all.
+  - With a directory configured, entries persist across runs as
+    embeddings.npy + replies.jsonl.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+EMBEDDING_MODEL      = "text-embedding-3-small"
+SIMILARITY_THRESHOLD = 0.92
+MAX_EMBED_CHARS      = 24000   # stay well below the embedding model's 8k-token input limit
+
+def _digest(obj: Any) -> str:
+    return hashlib.sha256(json.dumps(obj, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def partition_key(model: str, messages: List[Dict[str, str]]) -> str:
+    """Key that separates contexts: same model plus the same preceding history.
+
+    Only as specific as that history: requests made of one static system
+    prompt and one message all land in the same partition.
+    """
+    return _digest([model, messages[:-1]])
+
+def exact_key(model: str, messages: List[Dict[str, str]], temperature: float, top_p: float) -> str:
+    return _digest([model, temperature, top_p, messages])
+
+def embedding_input(messages: List[Dict[str, str]]) -> str:
+    """Text to embed: the newest message (its head, when long)."""
+    return messages[-1]["content"][:MAX_EMBED_CHARS]
+
+class SemanticCache:
+    def __init__(self, path: Optional[str] = None, threshold: float = SIMILARITY_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self.embeddings: Optional[np.ndarray] = None   # (N, dim), rows L2-normalised
+        self.partitions: List[str] = []
+        self.replies: List[str] = []
+        self.exact: Dict[str, str] = {}
+        # One instance may be shared by several threads (e.g. Streamlit
+        # sessions); add() updates three parallel lists that lookup() reads.
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load()
+
+    # -- exact-match layer (temperature == 0) --
+    def get_exact(self, key: str) -> Optional[str]:
+        return self.exact.get(key)
+
+    def put_exact(self, key: str, reply: str) -> None:
+        self.exact[key] = reply
+
+    # -- semantic layer --
+    def lookup(self, partition: str, embedding: Sequence[float]) -> Optional[str]:
+        query = _normalise(embedding)
+        with self._lock:
+            if self.embeddings is None:
+                return None
+            scores = self.embeddings @ query
+            scores[np.array(self.partitions) != partition] = -1.0
+            best = int(scores.argmax())
+            if scores[best] >= self.threshold:
+                return self.replies[best]
+            return None
+
+    def add(self, partition: str, embedding: Sequence[float], reply: str) -> None:
+        row = _normalise(embedding)[None, :]
+        with self._lock:
+            self.embeddings = row if self.embeddings is None else np.concatenate([self.embeddings, row])
+            self.partitions.append(partition)
+            self.replies.append(reply)
+            if self.path:
+                with open(os.path.join(self.path, "replies.jsonl"), "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"partition": partition, "reply": reply}, ensure_ascii=False) + "\n")
+                np.save(os.path.join(self.path, "embeddings.npy"), self.embeddings)
+
+    def _load(self) -> None:
+        emb_path = os.path.join(self.path, "embeddings.npy")
+        rep_path = os.path.join(self.path, "replies.jsonl")
+        if not (os.path.exists(emb_path) and os.path.exists(rep_path)):
+            return
+        embeddings = np.load(emb_path)
+        with open(rep_path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        # A crash between the two writes can leave one file a row ahead.
+        n = min(len(embeddings), len(rows))
+        if n < len(rows):
+            with open(rep_path, "w", encoding="utf-8") as f:
+                f.writelines(json.dumps(r, ensure_ascii=False) + "\n" for r in rows[:n])
+        if n:
+            self.embeddings = embeddings[:n]
+            self.partitions = [r["partition"] for r in rows[:n]]
+            self.replies = [r["reply"] for r in rows[:n]]
+
+def _normalise(embedding: Sequence[float]) -> np.ndarray:
+    vec = np.asarray(embedding, dtype=np.float32)
+    return vec / (np.linalg.norm(vec) or 1.0)
@@ -1,8 +1,17 @@
-import re
-import json
 from datetime import datetime
+import httpx
 import streamlit as st
 
+from mediator_core import (
+    VERDICT_JSON_FORMAT,
+    SemanticCache,
+    call_chat,
+    compact_history,
+    dumps_json_bytes,
+    parse_verdict_reply,
+    stream_chat,
+)
+
 try:
     from openai import OpenAI
 except Exception:
@@ -15,16 +24,15 @@ st.set_page_config(page_title="Consultant ↔ Customer Mediator", layout="wide")
 # Auth (PIN Gate)
 # -----------------------------
 def require_pin():
-    if "auth_ok" not in st.session_state:
-        st.session_state.auth_ok = False
-    if "auth_tries" not in st.session_state:
-        st.session_state.auth_tries = 0
+    # Every rerun after unlocking takes this path: no secrets lookup, no widgets.
+    if st.session_state.get("auth_ok"):
+        return True
+    st.session_state.setdefault("auth_ok", False)
+    st.session_state.setdefault("auth_tries", 0)
 
     configured_pin = st.secrets.get("APP_PIN")
     if not configured_pin:
         st.stop()
-    if st.session_state.auth_ok:
-        return True
 
     st.markdown("### 🔐 Enter PIN to access the app")
     with st.form("pin_form", clear_on_submit=False):
@@ -51,67 +59,82 @@ require_pin()
 # -----------------------------
 # System Instructions (Single-Focus Version)
 # -----------------------------
-CONSULTANT_SYSTEM = """You are an AI Business Consultant and Subject Matter Expert (SME).
-
-Your goal is to propose ONE unique online business idea that is:
-- Powered primarily by AI (85%+ AI-driven implementation)
-- Fully automated (100% AI-run operations)
-- Profitable with minimal deployment cost (using existing APIs, SaaS tools, or open-source frameworks)
-
-Behavior:
-- Do not list multiple ideas.
-- Present only one concise idea.
-- Your idea must emphasize effectiveness and profitability.
-- Clearly highlight why it has minimal deployment cost.
-- Keep your response under 5 concise sentences.
-- Be practical, ROI-focused, and persuasive.
-- Wait for the Customer to respond with either acceptance or challenges.
-- Do not propose another idea unless the first is rejected.
+CONSULTANT_SYSTEM = """You are an AI business consultant and SME.
+
+Propose ONE unique online business idea that is:
+- 85%+ AI-driven to implement and 100% AI-run to operate
+- Profitable with minimal deployment cost (existing APIs, SaaS or open-source)
+
+Present only that idea in at most 5 concise sentences: practical, ROI-focused, persuasive, and explicit about why deployment is cheap. Then wait for the Customer. Propose another idea only if this one is rejected.
 """
 
 CUSTOMER_SYSTEM = """You are a skeptical Customer seeking a profitable, low-cost, AI-powered online business idea.
 
-Behavior:
-- Listen to only ONE idea at a time.
-- Challenge the Consultant ONLY on its profitability and low deployment cost.
-- Ask for clarification if any part of the idea seems vague, costly, or unconvincing.
-- Be concise (2–3 sentence responses).
-- Accept the idea only if it is clearly profitable AND has minimal setup cost.
-- If convinced, say: "I accept this idea."
-- If not convinced, say: "I reject this idea because..."
-- Do not ask for another idea unless the first is rejected.
+Consider one idea at a time and challenge ONLY its profitability and deployment cost; ask about anything vague or costly.
+Accept only if it is clearly profitable AND cheap to set up.
+
+Reply with JSON only: {"verdict": "accept" | "reject" | "continue", "rebuttal": "<your 2–3 sentence response>"}
+Use "continue" while you still have questions; "reject" only when the idea cannot work.
 """
 
-ACCEPT_PATTERNS = [
-    r"\bI accept this idea\b",
-    r"\bI am convinced\b",
-    r"\bThis is (feasible|profitable)\b",
-    r"\bI agree to proceed\b"
-]
-REJECT_PATTERNS = [
-    r"\bI reject this idea\b",
-    r"\bThis won't work\b",
-    r"\bNot acceptable\b",
-    r"\bI am not convinced\b"
-]
-
-def is_match(text, patterns):
-    for pat in patterns:
-        if re.search(pat, text, flags=re.IGNORECASE):
-            return True
-    return False
-
-def call_chat(client, model, system, user, temperature, top_p):
-    r = client.chat.completions.create(
-        model=model,
-        temperature=temperature,
-        top_p=top_p,
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": user},
-        ],
+# Default reply length caps (adjustable in the sidebar): decode time and cost
+# grow with every generated token.
+MAX_TOKENS_CONSULTANT = 700
+MAX_TOKENS_CUSTOMER = 300
+
+# History compaction: past this many tokens, an assistant's older messages
+# are replaced by a gpt-4o-mini summary, leaving about half the threshold
+# (and at least the newest few messages) so several turns fit before the next.
+SUMMARY_THRESHOLD_TOKENS = 6000
+SUMMARY_KEEP_MESSAGES = 4
+
+@st.cache_resource
+def get_openai_client():
+    # Built once per server process so its connection pool survives reruns;
+    # the API key is read from secrets only here. Failures raise rather than
+    # return, so they aren't cached and a fixed secret is picked up next time.
+    # Connects fail fast; a slow reply still gets a full minute.
+    api_key = st.secrets.get("OPENAI_API_KEY")
+    if OpenAI is None or not api_key:
+        raise RuntimeError("Missing dependencies or API key.")
+    return OpenAI(
+        api_key=api_key,
+        http_client=httpx.Client(
+            limits=httpx.Limits(max_keepalive_connections=10),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        ),
     )
-    return r.choices[0].message.content.strip()
+
+@st.cache_resource
+def get_semantic_cache():
+    # In-memory only; shared by all sessions of this server process.
+    return SemanticCache()
+
+# Short objections and mid-dialogue refinements don't need the large model.
+CHEAP_MODEL = "gpt-4o-mini"
+
+SPEAKERS = {"consultant": "Consultant", "customer": "Customer"}
+
+# Consultant temperatures below this are treated as deterministic, so the
+# opening proposal for a given history can be memoised.
+OPENING_CACHE_MAX_TEMP = 0.1
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def cached_opening(model, messages, temperature, top_p, max_tokens):
+    # Keyed on the full request (messages include the system prompt), shared
+    # across sessions; "Clear Transcript" drops it.
+    return call_chat(get_openai_client(), model, messages, temperature, top_p, max_tokens=max_tokens)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_exports(turns):
+    # `turns` is a tuple of (role, content) pairs: reruns that don't change the
+    # transcript (slider moves, downloads) reuse the serialized text. Only the
+    # current transcripts are ever re-requested, so a few entries suffice.
+    md_text = "# Two-Assistant Dialogue Transcript\n\n" + "".join(
+        f"## {SPEAKERS[role]}\n\n{content}\n\n---\n\n" for role, content in turns
+    )
+    json_bytes = dumps_json_bytes([{"role": role, "content": content} for role, content in turns], indent=True)
+    return md_text, json_bytes
 
 # -----------------------------
 # UI
@@ -121,62 +144,125 @@ st.caption("One AI-first business idea only — must be profitable and low-cost
 
 with st.sidebar:
     st.header("⚙️ Settings")
-    model_consultant = st.text_input("Consultant model", value="gpt-4o")
-    model_customer = st.text_input("Customer model", value="gpt-4o")
-    temp_consultant = st.slider("Consultant Temperature", 0.0, 1.0, 0.7, 0.05)
-    temp_customer = st.slider("Customer Temperature", 0.0, 1.0, 0.45, 0.05)
-    top_p_consultant = st.slider("Consultant Top-p", 0.1, 1.0, 1.0, 0.05)
-    top_p_customer = st.slider("Customer Top-p", 0.1, 1.0, 1.0, 0.05)
-    max_turns = st.number_input("Max dialogue turns", min_value=1, max_value=20, value=6)
+    # Changes take effect (and rerun the script) only when Apply is pressed,
+    # not on every slider drag.
+    with st.form("settings"):
+        model_consultant = st.text_input("Consultant model", value="gpt-4o")
+        model_customer = st.text_input("Customer model", value=CHEAP_MODEL)
+        cost_routing = st.checkbox(
+            "Aggressive cost routing",
+            value=False,
+            help=f"Use {CHEAP_MODEL} for the consultant's middle refinements; the opening and the last turns keep the consultant model.",
+        )
+        temp_consultant = st.slider("Consultant Temperature", 0.0, 1.0, 0.7, 0.05)
+        temp_customer = st.slider("Customer Temperature", 0.0, 1.0, 0.45, 0.05)
+        top_p_consultant = st.slider("Consultant Top-p", 0.1, 1.0, 1.0, 0.05)
+        top_p_customer = st.slider("Customer Top-p", 0.1, 1.0, 1.0, 0.05)
+        max_turns = st.number_input("Max dialogue turns", min_value=1, max_value=20, value=6)
+        max_tokens_consultant = st.number_input("Consultant max reply tokens", min_value=50, max_value=4000, value=MAX_TOKENS_CONSULTANT, step=50)
+        max_tokens_customer = st.number_input("Customer max reply tokens", min_value=50, max_value=4000, value=MAX_TOKENS_CUSTOMER, step=50)
+        use_cache = st.checkbox("Reuse near-identical replies (semantic cache)", value=False)
+        st.form_submit_button("Apply")
     st.markdown("---")
     if st.button("🔓 Log out"):
         logout()
     start_btn = st.button("▶️ Start Dialogue", type="primary")
     clear_btn = st.button("🔄 Clear Transcript")
 
+# No rerun needed: the initialisation below and the render at the bottom run
+# later in this same pass and already see the cleared state.
 if clear_btn:
     st.session_state.pop("transcript", None)
-    st.rerun()
+    st.session_state.pop("consultant_msgs", None)
+    st.session_state.pop("customer_msgs", None)
+    st.session_state.pop("ts", None)
+    cached_opening.clear()
 
 if "transcript" not in st.session_state:
     st.session_state.transcript = []
+# Per-assistant histories live as long as the transcript does, so the system
+# prompt and earlier turns stay byte-identical (and prefix-cacheable) across
+# every call, including later Start Dialogue runs in the same session.
+if "consultant_msgs" not in st.session_state:
+    st.session_state.consultant_msgs = [{"role": "system", "content": CONSULTANT_SYSTEM}]
+    st.session_state.customer_msgs = [{"role": "system", "content": CUSTOMER_SYSTEM}]
 
 transcript = st.session_state.transcript
 
+def render_transcript(turns):
+    # One element per message: a reply cut off mid code fence or mid **bold**
+    # (e.g. at max_tokens) then can't garble the messages after it.
+    for t in turns:
+        st.markdown(f"**{SPEAKERS[t['role']]}:**\n\n{t['content']}\n\n---")
+
 if start_btn:
-    if OpenAI is None or "OPENAI_API_KEY" not in st.secrets:
-        st.error("Missing dependencies or API key.")
+    try:
+        client = get_openai_client()
+    except RuntimeError as e:
+        st.error(str(e))
         st.stop()
 
-    client = OpenAI(api_key=st.secrets.get("OPENAI_API_KEY"))
+    st.session_state.ts = datetime.now().strftime("%Y%m%d_%H%M%S")   # export file names
+    cache = get_semantic_cache() if use_cache else None
     accepted, rejected = False, False
     turn = 0
-    placeholder = st.empty()
+    if transcript:
+        render_transcript(transcript)   # earlier runs of this session
+    dialogue = st.container()   # append-only: each message is written once
+
+    def compact(msgs, model):
+        # Never through the shared semantic cache: all summary requests share
+        # one partition, so a hit could hand this session another user's summary.
+        compact_history(client, msgs, model, SUMMARY_THRESHOLD_TOKENS, SUMMARY_KEEP_MESSAGES)
+
+    def stream_reply(speaker, stream):
+        with dialogue:
+            st.markdown(f"**{speaker}:**")
+            reply = st.write_stream(stream).strip()
+            st.markdown("---")
+        return reply
+
+    consultant_msgs = st.session_state.consultant_msgs
+    customer_msgs = st.session_state.customer_msgs
 
     # First idea from Consultant
-    consultant_prompt = "Propose a unique AI-first online business idea that is profitable and has minimal deployment cost."
-    consultant_reply = call_chat(client, model_consultant, CONSULTANT_SYSTEM, consultant_prompt, temp_consultant, top_p_consultant)
+    consultant_msgs.append({"role": "user", "content": "Propose a unique AI-first online business idea that is profitable and has minimal deployment cost."})
+    compact(consultant_msgs, model_consultant)
+    if temp_consultant < OPENING_CACHE_MAX_TEMP:
+        opening = [cached_opening(model_consultant, consultant_msgs, temp_consultant, top_p_consultant, max_tokens_consultant)]
+    else:
+        opening = stream_chat(client, model_consultant, consultant_msgs, temp_consultant, top_p_consultant, cache, max_tokens_consultant)
+    consultant_reply = stream_reply(SPEAKERS["consultant"], opening)
+    consultant_msgs.append({"role": "assistant", "content": consultant_reply})
     transcript.append({"role": "consultant", "content": consultant_reply})
+    customer_prompt = f"The Consultant proposed this idea:\n\n{consultant_reply}\n\nEvaluate ONLY its profitability and deployment cost. Respond in JSON."
 
     while turn < max_turns and not (accepted or rejected):
         turn += 1
 
-        customer_prompt = f"The Consultant proposed this idea:\n\n{consultant_reply}\n\nEvaluate ONLY its profitability and deployment cost. Respond in 2–3 sentences."
-        customer_reply = call_chat(client, model_customer, CUSTOMER_SYSTEM, customer_prompt, temp_customer, top_p_customer)
+        customer_msgs.append({"role": "user", "content": customer_prompt})
+        compact(customer_msgs, model_customer)
+        # JSON mode: the verdict is a field, not a phrase to search for. The raw
+        # JSON stays in the history so the model keeps answering in that shape.
+        customer_json = call_chat(client, model_customer, customer_msgs, temp_customer, top_p_customer, cache, max_tokens_customer, response_format=VERDICT_JSON_FORMAT)
+        customer_msgs.append({"role": "assistant", "content": customer_json})
+        verdict, customer_reply = parse_verdict_reply(customer_json)
+        stream_reply(SPEAKERS["customer"], [customer_reply])
         transcript.append({"role": "customer", "content": customer_reply})
 
-        accepted = is_match(customer_reply, ACCEPT_PATTERNS)
-        rejected = is_match(customer_reply, REJECT_PATTERNS)
+        accepted = verdict == "accept"
+        rejected = verdict == "reject"
 
         if not accepted and not rejected:
-            consultant_prompt = f"The Customer replied:\n\n{customer_reply}\n\nRefine the SAME idea to better prove its profitability and minimal deployment cost. Keep your reply short."
-            consultant_reply = call_chat(client, model_consultant, CONSULTANT_SYSTEM, consultant_prompt, temp_consultant, top_p_consultant)
+            consultant_msgs.append({"role": "user", "content": f"The Customer replied:\n\n{customer_reply}\n\nRefine the SAME idea to better prove its profitability and minimal deployment cost. Keep your reply short."})
+            refine_model = model_consultant
+            if cost_routing and 1 < turn < max_turns - 2:
+                refine_model = CHEAP_MODEL
+            compact(consultant_msgs, refine_model)
+            consultant_reply = stream_reply(SPEAKERS["consultant"], stream_chat(client, refine_model, consultant_msgs, temp_consultant, top_p_consultant, cache, max_tokens_consultant))
+            consultant_msgs.append({"role": "assistant", "content": consultant_reply})
             transcript.append({"role": "consultant", "content": consultant_reply})
-
-        with placeholder.container():
-            for t in transcript:
-                speaker = "Consultant" if t['role'] == 'consultant' else "Customer"
-                st.markdown(f"**{speaker}:**\n\n{t['content']}\n\n---")
+            customer_prompt = f"Refined idea:\n\n{consultant_reply}"
 
     if accepted:
         st.success("Customer accepted the idea!")
@@ -185,17 +271,12 @@ if start_btn:
     else:
         st.warning("Max turns reached.")
 
-for t in transcript:
-    speaker = "Consultant" if t["role"] == "consultant" else "Customer"
-    st.markdown(f"**{speaker}:**\n\n{t['content']}\n\n---")
+# A run that just played the dialogue has already drawn every message.
+if transcript and not start_btn:
+    render_transcript(transcript)
 
 if transcript:
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    md = ["# Two-Assistant Dialogue Transcript\n"]
-    for t in transcript:
-        speaker = "Consultant" if t["role"] == "consultant" else "Customer"
-        md.append(f"## {speaker}\n\n{t['content']}\n\n---\n")
-    md_text = "\n".join(md)
-    json_text = json.dumps(transcript, ensure_ascii=False, indent=2)
+    ts = st.session_state.ts
+    md_text, json_bytes = build_exports(tuple((t["role"], t["content"]) for t in transcript))
     st.download_button("⬇️ Download transcript (.md)", data=md_text, file_name=f"dialogue_{ts}.md")
-    st.download_button("⬇️ Download transcript (.json)", data=json_text, file_name=f"dialogue_{ts}.json")
+    st.download_button("⬇️ Download transcript (.json)", data=json_bytes, file_name=f"dialogue_{ts}.json", mime="application/json")